@@ -8,7 +8,180 @@
 """
 
 import numpy as np
-from scipy.optimize import fmin
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from numba import njit
+from scipy.optimize import least_squares
+from scipy.sparse import csr_matrix
+
+@njit(cache = True, fastmath = True)
+def _cost_kernel(Theta_flat, ranges_sq_ik, valid_ik, n_anchors, fixed_anchors, Theta_init):
+    """ Stage 2 target function (see AutocalibrationSolver.costOpt)
+    Parameters
+    ----------
+    Theta_flat: (N * 3, ) array
+        current array of anchors coordinates (x,y,z)
+    ranges_sq_ik: (N, N) array
+        squared inter anchor ranges
+    valid_ik: (N, N) bool array
+        bool mask of valid ranges (i.e. ranges >= 0 and i != k)
+    n_anchors: int
+        total number of anchors
+    fixed_anchors: (N, ) bool array
+        bool mask of fixed anchors
+    Theta_init: (N, 3) array
+        initial anchor coordinates
+    Returns
+    -------
+    cost: float
+    """
+    Theta = Theta_flat.reshape(n_anchors, 3)
+    cost = 0.0
+    for i in range(n_anchors):
+        # keep fixed anchors at their initial coordinates
+        Theta_i = Theta_init[i] if fixed_anchors[i] else Theta[i]
+        # distances are symmetric, compute them once for (i, j) and (j, i) costs
+        for j in range(i + 1, n_anchors):
+            if not (valid_ik[i, j] or valid_ik[j, i]): continue
+            Theta_j = Theta_init[j] if fixed_anchors[j] else Theta[j]
+            dx = Theta_i[0] - Theta_j[0]
+            dy = Theta_i[1] - Theta_j[1]
+            dz = Theta_i[2] - Theta_j[2]
+            distance_sq = dx * dx + dy * dy + dz * dz
+            if valid_ik[i, j]:
+                residual = distance_sq - ranges_sq_ik[i, j]
+                cost += residual * residual
+            if valid_ik[j, i]:
+                residual = distance_sq - ranges_sq_ik[j, i]
+                cost += residual * residual
+    return cost
+
+# no nnan/ninf fast-math flags so the singular system check stays well defined
+@njit(cache = True, fastmath = {'contract', 'reassoc'})
+def _lsq_3(A, B):
+    """ Least squares solution of A x = B with 3 unknowns through the
+        normal equations, the 3x3 system is solved with its cofactors.
+        Falls back to np.linalg.lstsq (minimum norm solution) if A.T @ A
+        is singular (e.g. coplanar anchors)
+    Parameters
+    ----------
+    A: (M, 3) array
+    B: (M, ) array
+    Returns
+    -------
+    x: (3, ) array
+        NaN if the system is not finite (i.e. stage 1 has diverged)
+    """
+    ATA = np.zeros((3, 3))
+    ATB = np.zeros(3)
+    for p in range(A.shape[0]):
+        for r in range(3):
+            ATB[r] += A[p, r] * B[p]
+            for c in range(3):
+                ATA[r, c] += A[p, r] * A[p, c]
+    # cofactors (ATA is symmetric so the adjugate is the cofactors matrix)
+    c00 = ATA[1, 1] * ATA[2, 2] - ATA[1, 2] * ATA[2, 1]
+    c01 = ATA[1, 2] * ATA[2, 0] - ATA[1, 0] * ATA[2, 2]
+    c02 = ATA[1, 0] * ATA[2, 1] - ATA[1, 1] * ATA[2, 0]
+    c11 = ATA[0, 0] * ATA[2, 2] - ATA[0, 2] * ATA[2, 0]
+    c12 = ATA[0, 1] * ATA[2, 0] - ATA[0, 0] * ATA[2, 1]
+    c22 = ATA[0, 0] * ATA[1, 1] - ATA[0, 1] * ATA[1, 0]
+    det = ATA[0, 0] * c00 + ATA[0, 1] * c01 + ATA[0, 2] * c02
+    scale = max(ATA[0, 0], ATA[1, 1], ATA[2, 2])
+    # diverged coords, lstsq cannot be called with non finite values
+    if not (np.isfinite(det) and np.isfinite(scale)):
+        return np.full(3, np.nan)
+    if abs(det) <= 1e-10 * scale * scale * scale:
+        return np.linalg.lstsq(A, B)[0]
+    x = np.empty(3)
+    x[0] = (c00 * ATB[0] + c01 * ATB[1] + c02 * ATB[2]) / det
+    x[1] = (c01 * ATB[0] + c11 * ATB[1] + c12 * ATB[2]) / det
+    x[2] = (c02 * ATB[0] + c12 * ATB[1] + c22 * ATB[2]) / det
+    return x
+
+# no nnan/ninf fast-math flags so the singular system check stays well defined
+@njit(cache = True, fastmath = {'contract', 'reassoc'})
+def _stage_one_kernel(samples_ik, coords, coords_old, fixed_anchors, max_iters, convergence_thresh_sq, LSq_min_anchors):
+    """ Stage 1 iterations (see AutocalibrationSolver.stageOne), coords are
+        updated in place anchor by anchor with a LSq multilateration
+        (see AutocalibrationSolver.coordinatesOpt)
+    Parameters
+    ----------
+    samples_ik: (N, N) array
+        inter anchor ranges
+    coords: (N, 3) array
+        anchor coordinates, updated in place
+    coords_old: (N, 3) array
+        scratch buffer for previous iteration coords
+    fixed_anchors: (N, ) bool array
+        bool mask of fixed anchors
+    convergence_thresh_sq: float
+        squared convergence_thresh
+    max_iters, LSq_min_anchors:
+        see AutocalibrationSolver
+    Returns
+    -------
+    diverged: bool
+        True if iterations stopped because coords are no longer finite
+    """
+    n_anchors = coords.shape[0]
+    # valid ranges (i.e. range >= 0) indices of each anchor
+    valid_k = np.empty((n_anchors, n_anchors), dtype = np.int64)
+    n_valid = np.zeros(n_anchors, dtype = np.int64)
+    for i in range(n_anchors):
+        for k in range(n_anchors):
+            if samples_ik[i, k] >= 0.0:
+                valid_k[i, n_valid[i]] = k
+                n_valid[i] += 1
+    A = np.empty((n_anchors, 3))
+    B = np.empty(n_anchors)
+
+    for _ in range(max_iters):
+        # save previous anchors coords for termination condition
+        coords_old[:] = coords
+
+        # update anchors coords
+        for i in range(n_anchors):
+            # don't update fixed anchors or anchors without enough ranges
+            m = n_valid[i]
+            if fixed_anchors[i] or m < LSq_min_anchors: continue
+            # last valid anchor is the reference
+            ref = valid_k[i, m - 1]
+            ref_sq = coords[ref, 0] * coords[ref, 0] + coords[ref, 1] * coords[ref, 1] + coords[ref, 2] * coords[ref, 2]
+            ref_range_sq = samples_ik[i, ref] * samples_ik[i, ref]
+            for p in range(m - 1):
+                k = valid_k[i, p]
+                k_sq = coords[k, 0] * coords[k, 0] + coords[k, 1] * coords[k, 1] + coords[k, 2] * coords[k, 2]
+                for c in range(3):
+                    A[p, c] = 2.0 * (coords[ref, c] - coords[k, c])
+                B[p] = samples_ik[i, k] * samples_ik[i, k] - ref_range_sq - k_sq + ref_sq
+            coords[i] = _lsq_3(A[:m - 1], B[:m - 1])
+            if not (np.isfinite(coords[i, 0]) and np.isfinite(coords[i, 1]) and np.isfinite(coords[i, 2])):
+                return True
+
+        # termination criterion -> autocalibrated coords have not been modified significantly
+        diff_sq = 0.0
+        for i in range(n_anchors):
+            for c in range(3):
+                diff = coords[i, c] - coords_old[i, c]
+                diff_sq += diff * diff
+        if diff_sq < convergence_thresh_sq:
+            break
+    return False
+
+def _solveSample(solver, sample_idx):
+    """ Solve stages 1 and 2 for a single sample starting from the initial
+        guess (see AutocalibrationSolver.solveSamples)
+    Returns
+    -------
+    autocalibrated_coords: (N, 3) array
+    """
+    np.copyto(solver.autocalibrated_coords, solver.initial_guess)
+    solver.stageOne(sample_idx = sample_idx)
+    solver.stageTwo(sample_idx = sample_idx)
+    # autocalibrated_coords buffer is reused by the next sample of the chunk
+    return np.copy(solver.autocalibrated_coords)
 
 class AutocalibrationSolver(object):
     def __init__(self, autocalibration_samples, initial_guess, fixed_anchors, max_iters = 1500, convergence_thresh = 0.01, LSq_min_anchors = 4, lower_percentile = 0.25, upper_percentile = 0.75, verbose = False):
@@ -36,9 +209,12 @@ class AutocalibrationSolver(object):
         upper_percentile: float
             same as lower percentile but this time is upper limit
         """
-        self.samples_ijk = autocalibration_samples
+        # ranges have ~cm precision, float32 halves memory traffic of the samples reductions
+        self.samples_ijk = np.asarray(autocalibration_samples, dtype = np.float32)
         self.initial_guess = initial_guess
-        self.autocalibrated_coords = initial_guess
+        # stage 1 updates autocalibrated_coords in place so it does not share memory with initial_guess
+        self.autocalibrated_coords = np.array(initial_guess, dtype = np.float64, copy = True)
+        self._coords_old_buf = np.empty_like(self.autocalibrated_coords)
         self.fixed_anchors = fixed_anchors
         self.max_iters = max_iters
         self.convergence_thresh = convergence_thresh
@@ -46,6 +222,59 @@ class AutocalibrationSolver(object):
         self.lower_percentile = lower_percentile
         self.upper_percentile = upper_percentile
         self.verbose = verbose
+        self._median_ik = None
+        self._lower_bounds = None
+        self._upper_bounds = None
+
+    def medianRanges(self):
+        """ Median (N, N) inter-anchor ranges array discarding bad ranges
+            (i.e. range = -1.0). It does not depend on the current estimation
+            so it is computed once and cached. Only the middle samples are
+            placed with np.partition instead of fully sorting each pair samples
+        Returns
+        -------
+        median_ik: (N, N) array
+            median ranges, -1.0 where no valid range has been received
+        """
+        n_anchors, n_samples, _ = self.samples_ijk.shape
+        if self._median_ik is None and n_samples == 0:
+            # no samples at all, every range is a bad range
+            self._median_ik = -np.ones((n_anchors, n_anchors))
+        elif self._median_ik is None:
+            valid = self.samples_ijk > 0.0
+            n_valid = np.count_nonzero(valid, axis = 1)
+            # middle positions of the valid samples (equal if n_valid is odd)
+            last_idx = np.maximum(n_valid - 1, 0)
+            lower_idx = last_idx // 2
+            upper_idx = np.minimum(n_valid // 2, last_idx)
+            # bad ranges are placed last so the first n_valid samples are the valid ones
+            kth = np.unique(np.concatenate((lower_idx.ravel(), upper_idx.ravel())))
+            partitioned = np.partition(np.where(valid, self.samples_ijk, np.inf), kth, axis = 1)
+            lower = np.take_along_axis(partitioned, lower_idx[:, None, :], axis = 1)[:, 0, :]
+            upper = np.take_along_axis(partitioned, upper_idx[:, None, :], axis = 1)[:, 0, :]
+            self._median_ik = np.where(n_valid > 0, 0.5 * (lower + upper), -1.0)
+        return self._median_ik
+
+    def rangeBounds(self):
+        """ Lower and upper (N, N) inter-anchor ranges percentiles used to
+            filter samples in stage 2, discarding bad ranges (i.e. range = -1.0).
+            Samples are sorted once along the samples axis so each percentile
+            is a linear interpolation between two sorted samples
+        Returns
+        -------
+        lower_bounds: (N, N) array
+            lower_percentile of ranges, -1.0 where no valid range has been received
+        upper_bounds: (N, N) array
+            upper_percentile of ranges, -1.0 where no valid range has been received
+        """
+        if self._lower_bounds is None:
+            valid = self.samples_ijk > 0.0
+            n_valid = np.count_nonzero(valid, axis = 1)
+            # bad ranges are sorted last so the first n_valid samples are the valid ones
+            sorted_samples = np.sort(np.where(valid, self.samples_ijk, np.inf), axis = 1)
+            self._lower_bounds = AutocalibrationSolver.sortedPercentile(sorted_samples, n_valid, self.lower_percentile)
+            self._upper_bounds = AutocalibrationSolver.sortedPercentile(sorted_samples, n_valid, self.upper_percentile)
+        return self._lower_bounds, self._upper_bounds
 
     def preconditioner(self, samples_ik):
         """ Turn samples_ik into a symmetric matrix
@@ -83,46 +312,22 @@ class AutocalibrationSolver(object):
             sample index for which the stage 1 is performed
             if it is not provided the median will be computed
         """
-        n_anchors, _, _ = self.samples_ijk.shape
         # if sample_idx is provided stageOne is performed for that index and for the median otherwise
         if sample_idx is None: 
-            # compute median (n_anchors, n_anchors) array discarding bad ranges (i.e. range = -1.0)
-            samples_ik = np.empty((n_anchors, n_anchors), dtype = float)
-            for i in range(n_anchors):
-                for k in range(n_anchors):
-                    samples = self.samples_ijk[i,:,k][self.samples_ijk[i,:,k] > 0]
-                    if samples.shape[0] > 0: samples_ik[i,k] = np.median(samples)
-                    else: samples_ik[i,k] = -1.0
+            # median (n_anchors, n_anchors) array discarding bad ranges (i.e. range = -1.0)
+            samples_ik = self.medianRanges()
         else: 
-            samples_ik = np.copy(self.samples_ijk[:,sample_idx,:])
-
-        #samples_ik = self.preconditioner(samples_ik)
+            samples_ik = self.samples_ijk[:,sample_idx,:]
 
-        for _ in range(self.max_iters):
-            # save previous anchors coords for termination condition
-            autocalibrated_coords_old = np.copy(self.autocalibrated_coords)
-
-            # update anchors coords
-            for i in range(n_anchors):
-                # don't update fixed anchor
-                if self.fixed_anchors[i] == True: continue
-                _anchors_coords = []
-                _ranges = []
-                for k in range(n_anchors):
-                    # skip if range has not been received (i.e. range  == -1)
-                    if samples_ik[i,k] < 0.0: continue
-                    _anchors_coords.append(self.autocalibrated_coords[k])
-                    _ranges.append(samples_ik[i,k])
-
-                if len(_anchors_coords) >= self.LSq_min_anchors:
-                    _anchors_coords = np.array(_anchors_coords)
-                    _ranges = np.array(_ranges)
-                    self.autocalibrated_coords[i] = AutocalibrationSolver.coordinatesOpt(_anchors_coords, _ranges)
-
-            # termination criterion -> autocalibrated coords have not been modified significantly
-            if np.abs(np.linalg.norm(self.autocalibrated_coords - autocalibrated_coords_old)) < self.convergence_thresh:
-                break
+        # samples_ik is read-only (preconditioner modifies it in place, copy it first if enabled)
+        #samples_ik = self.preconditioner(np.copy(samples_ik))
 
+        # autocalibrated_coords is only reallocated if it has been replaced by a non float64 array
+        self.autocalibrated_coords = np.ascontiguousarray(self.autocalibrated_coords, dtype = np.float64)
+        diverged = _stage_one_kernel(np.ascontiguousarray(samples_ik, dtype = np.float64), self.autocalibrated_coords, self._coords_old_buf,
+                                     np.asarray(self.fixed_anchors, dtype = np.bool_), self.max_iters, self.convergence_thresh ** 2, self.LSq_min_anchors)
+        if diverged:
+            raise np.linalg.LinAlgError('Stage 1 did not converge (non finite anchor coordinates)')
 
     def stageTwo(self, sample_idx = None):
         """ Stage 2 of multi-stage procedure
@@ -132,36 +337,57 @@ class AutocalibrationSolver(object):
             sample index for which the stage 2 is performed
             if it is not provided the median will be computed
         """
-        n_anchors, _, _ = self.samples_ijk.shape
         # if sample_idx is provided stageOne is performed for that index and for the median otherwise
         if sample_idx is None: 
-            # compute median (n_anchors, n_anchors) array not taking into account bad ranges (i.e. range = -1.0)
-            _samples_ik = -np.ones((n_anchors, n_anchors), dtype = float)
-            for i in range(n_anchors):
-                for k in range(n_anchors):
-                    samples = self.samples_ijk[i,:,k][self.samples_ijk[i,:,k] > 0]
-                    if samples.shape[0] > 0: _samples_ik[i,k] = np.median(samples)
+            # median (n_anchors, n_anchors) array not taking into account bad ranges (i.e. range = -1.0)
+            _samples_ik = self.medianRanges()
         else:  
-            samples_ik = np.copy(self.samples_ijk[:,sample_idx,:])
-            # build upper_bounds and lower_bounds matrices
-            upper_bounds = -np.ones((samples_ik.shape), dtype = float)
-            lower_bounds = -np.ones((samples_ik.shape), dtype = float)
-            for i in range(n_anchors):
-                for k in range(n_anchors):
-                    samples = self.samples_ijk[i,:,k][self.samples_ijk[i,:,k] > 0.0]
-                    if samples.shape[0] > 0:
-                        lower_bounds[i, k] = np.percentile(samples, self.lower_percentile)
-                        upper_bounds[i, k] = np.percentile(samples, self.upper_percentile)
+            samples_ik = self.samples_ijk[:,sample_idx,:]
+            # upper_bounds and lower_bounds matrices do not depend on sample_idx
+            lower_bounds, upper_bounds = self.rangeBounds()
             mask1 = samples_ik <= upper_bounds
             mask2 = samples_ik >= lower_bounds
             mask = mask1 & mask2
             # filter ranges outside limits
-            _samples_ik = -np.ones(samples_ik.shape)
-            _samples_ik[mask] = samples_ik[mask]
+            _samples_ik = np.where(mask, samples_ik, -1.0)
 
-        #_samples_ik = self.preconditioner(_samples_ik)
-        # optimization based on scipy.optimize.fmin
-        self.autocalibrated_coords =  AutocalibrationSolver.costOpt(self.autocalibrated_coords, _samples_ik, self.fixed_anchors, self.verbose)
+        #_samples_ik = self.preconditioner(np.copy(_samples_ik))
+        # optimization based on scipy.optimize.least_squares
+        # autocalibrated_coords is only reallocated if it has been replaced by a non float64 array
+        self.autocalibrated_coords = np.ascontiguousarray(self.autocalibrated_coords, dtype = np.float64)
+        np.copyto(self.autocalibrated_coords, AutocalibrationSolver.costOpt(self.autocalibrated_coords, _samples_ik, self.fixed_anchors, self.verbose))
+
+    def solveSamples(self, max_workers = None):
+        """ Solve stages 1 and 2 independently for every sample j starting
+            from the initial guess. Samples are distributed among worker processes
+            (solved in this process if max_workers is 1)
+        Parameters
+        ----------
+        max_workers (optional): int
+            number of worker processes, os.cpu_count() if not provided
+        Returns
+        -------
+        autocalibrated_coords_j: (N, 3, M) array
+            autocalibrated anchor coordinates for each sample j
+        """
+        n_anchors, n_samples, _ = self.samples_ijk.shape
+        if n_samples == 0: return np.empty((n_anchors, 3, 0))
+        if max_workers is None: max_workers = os.cpu_count() or 1
+        # compute cached stage 2 bounds before the solver is sent to the workers
+        self.rangeBounds()
+        if max_workers == 1:
+            # leave autocalibrated_coords untouched as worker processes do
+            autocalibrated_coords = np.copy(self.autocalibrated_coords)
+            try:
+                coords_j = [_solveSample(self, j) for j in range(n_samples)]
+            finally:
+                self.autocalibrated_coords = autocalibrated_coords
+        else:
+            # one chunk of samples per worker so the solver is sent to each worker only once
+            chunksize = -(-n_samples // max_workers)
+            with ProcessPoolExecutor(max_workers = max_workers) as executor:
+                coords_j = list(executor.map(partial(_solveSample, self), range(n_samples), chunksize = chunksize))
+        return np.stack(coords_j, axis = 2)
 
     def estimationError(self, gt, est = None, axis = None):
         """ Return estimation error computed as euclidean
@@ -187,7 +413,35 @@ class AutocalibrationSolver(object):
             est_error = self.autocalibrated_coords - gt
             return est_error[:, axis]
         else:
-            return np.sqrt(np.einsum("ijk->ij", (self.autocalibrated_coords[:, None, :] - gt) ** 2))
+            return np.linalg.norm(self.autocalibrated_coords - gt, axis = 1)
+
+    @staticmethod
+    def sortedPercentile(sorted_samples, n_valid, percentile):
+        """ Percentile along axis 1 with linear interpolation
+            (same as np.percentile) of presorted samples
+        Parameters
+        ----------
+        sorted_samples: (N, M, N) array
+            samples sorted along axis 1
+        n_valid: (N, N) array
+            number of valid samples, placed first in sorted_samples
+        percentile: float
+            percentile in [0, 100]
+        Returns
+        -------
+        percentile_ik: (N, N) array
+            samples percentile, -1.0 where there are no valid samples
+        """
+        # no samples at all, every range is a bad range
+        if sorted_samples.shape[1] == 0: return -np.ones(n_valid.shape)
+        position = percentile / 100.0 * np.maximum(n_valid - 1, 0)
+        lower_idx = np.floor(position).astype(int)
+        upper_idx = np.ceil(position).astype(int)
+        lower = np.take_along_axis(sorted_samples, lower_idx[:, None, :], axis = 1)[:, 0, :]
+        upper = np.take_along_axis(sorted_samples, upper_idx[:, None, :], axis = 1)[:, 0, :]
+        with np.errstate(invalid = 'ignore'):
+            percentile_ik = lower + (upper - lower) * (position - lower_idx)
+        return np.where(n_valid > 0, percentile_ik, -1.0)
 
     @staticmethod
     def coordinatesOpt(anchors_coords, ranges):
@@ -199,21 +453,26 @@ class AutocalibrationSolver(object):
             ranges: (N, ) array
                 anchor-tag range
             """
-            # build A matrix
-            A = 2 * np.copy(anchors_coords)
-            for i in range(A.shape[0] - 1): A[i] = A[-1] - A[i]
-            A = A[:-1] # remove last row
+            anchors_coords = np.asarray(anchors_coords, dtype = np.float64)
+            ranges = np.asarray(ranges, dtype = np.float64)
+            sq_norms = np.sum(anchors_coords * anchors_coords, axis = 1)
+            # build A matrix (last anchor is the reference)
+            A = 2.0 * (anchors_coords[-1] - anchors_coords[:-1])
 
             # build B matrix
-            B = np.copy(ranges)**2
-            B = B[:-1] - B[-1] - np.sum(anchors_coords**2, axis = 1)[:-1] + np.sum(anchors_coords[-1]**2, axis = 0)
+            ranges_sq = ranges * ranges
+            B = ranges_sq[:-1] - ranges_sq[-1] - sq_norms[:-1] + sq_norms[-1]
             
-            # solve LS and return
-            return np.dot(np.linalg.pinv(A), B)    
+            # solve LS (same closed-form 3x3 solve as stage 1)
+            return _lsq_3(A, B)
 
     @staticmethod
     def costOpt(anchors_coords, ranges_ik, fixed_anchors, verbose = False):
-        """ Cost optimization based on scipy.optimize.fmin 
+        """ Cost optimization based on scipy.optimize.least_squares
+            Residuals are |Theta_i - Theta_j|^2 - r_ij^2 for every valid
+            range r_ij (i.e. ranges >= 0 and i != j), so the sum of squared
+            residuals is the stage 2 cost (see _cost_kernel). Fixed anchors
+            are left out of the parameter vector
         Parameters
         ----------
         anchors_coords: (N, 3) array
@@ -227,47 +486,74 @@ class AutocalibrationSolver(object):
         Theta_opt: (N, 3) array
             optimized anchor coordinates
         """
-        def _my_opt_func(Theta, *args):
-            """ Optimize target function
-            Parameters
-            ----------
-            Theta: (N, 3)
-                current array of anchors coordinates (x,y,z)
-            args:
-                ranges_ik: array (N, N) 
-                    inter anchor ranges
-                n_anchors: int
-                    total number of anchors
-                fixed_anchors: (N, ) array
-                    bool mask of fixed anchors
-                Theta_init: (N, 3) array
-                    initial anchor coordinates
-            Returns
-            -------
-            cost: float
-            """
-            ranges_ik, n_anchors, fixed_anchors, Theta_init = args
-            Theta = Theta.reshape(n_anchors, 3)
-
-            # Modify current Theta to keep anchors fixed
-            Theta[fixed_anchors] = Theta_init[fixed_anchors]
-            # compute cost
-            distances_ij = np.einsum("ijk->ij", (Theta[:, None, :] - Theta) ** 2)
-            cost_ij = (distances_ij - ranges_ik ** 2) ** 2
-            # remove j = i costs
-            cost_ij[distances_ij == 0] = 0
-            # remove costs computed with invalid ranges (i.e. ranges < 0)
-            cost_ij[ranges_ik < 0.0] = 0
-            return np.sum(np.einsum("ij->i", cost_ij))
-
-        Theta_init = np.copy(anchors_coords)
+        Theta_init = np.ascontiguousarray(anchors_coords, dtype = np.float64)
         n_anchors = anchors_coords.shape[0]
-        args = ranges_ik, n_anchors, fixed_anchors, Theta_init
-        
-        if verbose: print(f'Before optimization: Cost = {_my_opt_func(anchors_coords, *args)}')
-        Theta_opt = fmin(_my_opt_func, anchors_coords, args = args, disp=False)    
-        if verbose: print(f'After optimization: Cost = {_my_opt_func(Theta_opt, *args)}')
-        Theta_opt = Theta_opt.reshape(anchors_coords.shape)
-        Theta_opt[fixed_anchors] = Theta_init[fixed_anchors]
+        ranges_ik = np.ascontiguousarray(ranges_ik, dtype = np.float64)
+        fixed_anchors = np.asarray(fixed_anchors, dtype = np.bool_)
+        free_anchors = ~fixed_anchors
+
+        # valid ranges (i.e. ranges >= 0 and i != j) and squared ranges do not depend on Theta
+        valid_ik = (ranges_ik >= 0.0) & ~np.eye(n_anchors, dtype = bool)
+        ranges_sq_ik = np.where(valid_ik, ranges_ik * ranges_ik, 0.0)
+
+        # valid (i, j) pairs and column of each free anchor coordinate in the parameter vector
+        i_idx, j_idx = np.nonzero(valid_ik)
+        ranges_sq = ranges_sq_ik[i_idx, j_idx]
+        n_params = 3 * np.count_nonzero(free_anchors)
+        param_idx = -np.ones((n_anchors, 3), dtype = int)
+        param_idx[free_anchors] = np.arange(n_params).reshape(-1, 3)
+
+        # distances are symmetric so they are computed once per a < b pair, (i, j) residual
+        # uses pair_idx distance and Theta_i - Theta_j = sign * (Theta_a - Theta_b)
+        a_idx, b_idx = np.nonzero(np.triu(valid_ik | valid_ik.T, k = 1))
+        pair_ik = np.empty((n_anchors, n_anchors), dtype = int)
+        pair_ik[a_idx, b_idx] = pair_ik[b_idx, a_idx] = np.arange(a_idx.shape[0])
+        pair_idx = pair_ik[i_idx, j_idx]
+        sign = np.where(i_idx < j_idx, 1.0, -1.0)
+
+        # jacobian sparsity structure: d(residual_p)/d(Theta_i) = 2 (Theta_i - Theta_j) and
+        # d(residual_p)/d(Theta_j) = -2 (Theta_i - Theta_j), only for free anchors
+        i_free = free_anchors[i_idx]
+        j_free = free_anchors[j_idx]
+        residual_idx = np.arange(i_idx.shape[0])
+        jac_rows = np.repeat(np.concatenate((residual_idx[i_free], residual_idx[j_free])), 3)
+        jac_cols = np.concatenate((param_idx[i_idx[i_free]], param_idx[j_idx[j_free]])).ravel()
+        jac_pair_idx = np.concatenate((pair_idx[i_free], pair_idx[j_free]))
+        jac_scale = np.concatenate((2.0 * sign[i_free], -2.0 * sign[j_free]))[:, None]
+
+        # scratch buffers reused by every residuals/jacobian evaluation
+        # (returned arrays are kept by least_squares so they are not reused)
+        Theta_buf = np.copy(Theta_init)
+        diff_buf = np.empty((a_idx.shape[0], 3))
+        Theta_b_buf = np.empty((a_idx.shape[0], 3))
+        jac_data_buf = np.empty((jac_pair_idx.shape[0], 3))
+
+        def _theta(x):
+            Theta_buf[free_anchors] = x.reshape(-1, 3)
+            return Theta_buf
+
+        def _diff(x):
+            Theta = _theta(x)
+            np.take(Theta, a_idx, axis = 0, out = diff_buf)
+            np.take(Theta, b_idx, axis = 0, out = Theta_b_buf)
+            return np.subtract(diff_buf, Theta_b_buf, out = diff_buf)
+
+        def _residuals(x):
+            diff = _diff(x)
+            return np.einsum('ij,ij->i', diff, diff)[pair_idx] - ranges_sq
+
+        def _jac(x):
+            diff = _diff(x)
+            np.take(diff, jac_pair_idx, axis = 0, out = jac_data_buf)
+            np.multiply(jac_data_buf, jac_scale, out = jac_data_buf)
+            return csr_matrix((jac_data_buf.ravel(), (jac_rows, jac_cols)), shape = (i_idx.shape[0], n_params))
+
+        args = ranges_sq_ik, valid_ik, n_anchors, fixed_anchors, Theta_init
+        if verbose: print(f'Before optimization: Cost = {_cost_kernel(Theta_init.ravel(), *args)}')
+        # nothing to optimize
+        if n_params == 0 or i_idx.shape[0] == 0: return np.copy(Theta_init)
+        result = least_squares(_residuals, Theta_init[free_anchors].ravel(), jac = _jac, method = 'trf')
+        Theta_opt = np.copy(_theta(result.x))
+        if verbose: print(f'After optimization: Cost = {_cost_kernel(Theta_opt.ravel(), *args)}')
 
         return Theta_opt
\ No newline at end of file
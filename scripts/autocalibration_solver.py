@@ -41,14 +41,16 @@ def getData(PATH_TO_DATA, anchor_id_list, n_samples):
     n_anchors = len(anchor_id_list)
     n_discarded_samples = 1
     n_samples -= n_discarded_samples # since we discard first sample
-    autocalibration_samples = np.empty((n_anchors, n_samples, n_anchors))
+    # samples not read are left as bad lectures (i.e. -1 values)
+    autocalibration_samples = np.full((n_anchors, n_samples, n_anchors), -1.0, dtype = np.float32)
     for i in range(n_anchors):
         try:
-            anchor_data = np.loadtxt(PATH_TO_DATA + '/' + anchor_id_list[i] + '_ranging_data.txt')
-            anchor_data = anchor_data[n_discarded_samples:] # discard first sample, usually filled with bad lectures (i.e. -1 values)
+            # discard first sample, usually filled with bad lectures (i.e. -1 values)
+            anchor_data = np.loadtxt(PATH_TO_DATA + '/' + anchor_id_list[i] + '_ranging_data.txt', dtype = np.float32,
+                                     skiprows = n_discarded_samples, max_rows = n_samples, ndmin = 2)
         except:
-            anchor_data = -np.ones((n_samples, n_anchors))
-        autocalibration_samples[i] = anchor_data
+            continue
+        autocalibration_samples[i, :anchor_data.shape[0]] = anchor_data
     return autocalibration_samples, n_samples
 
 def main():
@@ -130,30 +132,15 @@ def main():
     # solve stages 1 and 2 for all samples j 
     # (not using the median value, thus the resulting estimation will be the centroid of all coordinates estimation with each j)
     # [!] this procedure is discarded since estimations with median value are more accurate
-    autocalibrated_coords_j = np.empty((n_total_anchors, 3, n_samples), dtype = float)
+    autocalibrated_coords_j = autocalibration_solver.solveSamples()
     for j in range(n_samples):
-        autocalibration_solver.autocalibrated_coords = np.copy(initial_guess)
-        autocalibration_solver.stageOne(sample_idx = None)
-        autocalibration_solver.stageTwo(sample_idx = None)
-        autocalibrated_coords_j[:,:,j] = np.copy(autocalibration_solver.autocalibrated_coords)
-        # print progress
-        percentage_completed = "{:.2f}".format((j + 1)/n_samples * 100)
-        sys.stdout.write(f'\r {percentage_completed} % Complete')
-
         # print estimation for all samples
         my_colors[:,3] = intensities[j]
-        ax.scatter(autocalibration_solver.autocalibrated_coords[:,0], autocalibration_solver.autocalibrated_coords[:,1], autocalibration_solver.autocalibrated_coords[:,2], color = my_colors, marker = 'x')
-    print('\n')
+        ax.scatter(autocalibrated_coords_j[:,0,j], autocalibrated_coords_j[:,1,j], autocalibrated_coords_j[:,2,j], color = my_colors, marker = 'x')
     """
 
-    # results df
-    main_df = pd.DataFrame({
-        'anchor_id' : [],
-        'error [m]' : [],
-        'x_error [m]' : [],
-        'y_error [m]' : [],
-        'z_error [m]' :  []
-    })
+    # results df rows
+    rows = []
 
     # Used to save the values calculated at <nodes_cfg_label>_temp.yaml
     file1 = open(dwm1001_drivers_path + "/params/nodes_cfg/" + nodes_cfg_label + ".yaml", 'r')
@@ -189,15 +176,15 @@ def main():
         
         axis_error = anchor_coords_gt[i] - centroid
         euclidean_error = np.linalg.norm((anchor_coords_gt[i] - centroid))
-        row = pd.DataFrame({'anchor_id' : [anchor_id_list[i]],
-                            'error [m]' :   "{:.2f}".format(euclidean_error),
-                            'x_error [m]' : "{:.2f}".format(axis_error[0]),
-                            'y_error [m]' : "{:.2f}".format(axis_error[1]),
-                            'z_error [m]' : "{:.2f}".format(axis_error[2])
-                            })
-
-        main_df = main_df.append(row)
+        rows.append({'anchor_id' : anchor_id_list[i],
+                     'error [m]' :   f'{euclidean_error:.2f}',
+                     'x_error [m]' : f'{axis_error[0]:.2f}',
+                     'y_error [m]' : f'{axis_error[1]:.2f}',
+                     'z_error [m]' : f'{axis_error[2]:.2f}'
+                     })
 
+    # results df
+    main_df = pd.DataFrame(rows, columns = ['anchor_id', 'error [m]', 'x_error [m]', 'y_error [m]', 'z_error [m]'])
     print(main_df.to_string(index=False))
     #main_df.to_csv('autocalibration_campus_sport_new.csv')
     #np.savetxt('landmarks_est.txt', autocalibrated_coords)